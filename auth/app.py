@@ -2,10 +2,11 @@
 from fastapi import FastAPI, Depends, HTTPException
 # Extrae el token del header Authorization, Si no hay token, lanza automáticamente un 401 Unauthorized, para proteger endpoints y leer el token JWT | Permite leer automáticamente los campos username y password del form-data enviado en el request, Así no tenés que parsear el body vos a mano, para recibir usuario/clave en el login
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-# Este es un tipo de excepción, Lo usás para capturar errores cuando intentás decodificar/verificar un token, excepción que salta si el token está mal (caducado, manipulado, inválido) | Sirve para crear y verificar tokens JWT, librería para generar y verificar tokens
-from jose import JWTError, jwt
-# es la herramienta para manejar hashing y verificación de contraseñas
-from passlib.context import CryptContext
+# Sirve para crear y verificar tokens JWT (PyJWT: el HMAC lo resuelve hashlib/OpenSSL) | Este es un tipo de excepción, excepción que salta si el token está mal (caducado, manipulado, inválido)
+import jwt
+from jwt import InvalidTokenError as JWTError
+# es la herramienta para manejar hashing y verificación de contraseñas (extensión en C, sin la capa de passlib)
+import bcrypt
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from .db import Base, engine, SessionLocal
@@ -29,6 +30,10 @@ SECRET_KEY = os.getenv("SECRET_KEY", "changeme")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 # define cuanto tiempo dura un token antes de expirar
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60))
+# costo de bcrypt (2^rounds iteraciones); se puede bajar en desarrollo local
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# lista de algoritmos aceptados al verificar, armada una sola vez
+_JWT_ALGS = [ALGORITHM]
 
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY no está definida en pedidos/.env ni en el entorno")
@@ -44,8 +49,8 @@ print(
 
 
 
-# Crea el hashing de las contraseñas | usa bcrypt como algoritmo de hashing | Si en algún momento definís varios algoritmos en schemes, Automáticamente marcará como "deprecados" los que no sean el primero, podés migrar contraseñas viejas a un algoritmo más seguro cuando los usuarios vuelvan a loguearse
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hash de relleno: el login verifica contra él cuando el usuario no existe, así la respuesta tarda lo mismo y no delata qué emails están registrados
+_DUMMY_HASH = bcrypt.hashpw(b"x", bcrypt.gensalt(BCRYPT_ROUNDS))
 # Le dice a FastApi que el endpoint /login es el que le entrega el token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
@@ -63,13 +68,20 @@ def get_db():
     finally:
         db.close()
 
+# bcrypt solo usa los primeros 72 bytes de la contraseña
+def _password_bytes(password: str) -> bytes:
+    return password.encode()[:72]
+
 # sirve para comprobar si la contraseña ingresada en el login coincide con el hash guardado en la base de datos
 def verify_password(plain, hashed):
-    return password_context.verify(plain, hashed)
+    # los usuarios creados antes de guardar el hash como bytes lo tienen como texto
+    if isinstance(hashed, str):
+        hashed = hashed.encode()
+    return bcrypt.checkpw(_password_bytes(plain), hashed)
 
-# sirve para hashear la contraseña
+# sirve para hashear la contraseña (devuelve bytes, se guarda así en la base)
 def hash_password(password):
-    return password_context.hash(password)
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(BCRYPT_ROUNDS))
 
 # Generamos un JWT firmado con la secret key, dentro guarda el usuario y la expiracion
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -85,7 +97,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     try:
         # decodifica usanod la secret key y el algoritmo configurado
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=_JWT_ALGS)
         # Obtiene el usuario
         user_id: int = payload.get("sub")
         if user_id is None:
@@ -115,8 +127,11 @@ def register(email: str, password: str, role: str = "user", db: Session = Depend
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     # Busca al usuario en la base de datos
     user = db.query(User).filter(User.email == form_data.username).first()
-    # Verifica credenciales
-    if not user or not verify_password(form_data.password, user.password_hash):
+    # Verifica credenciales (siempre corre un bcrypt, exista o no el usuario)
+    if user is None:
+        bcrypt.checkpw(_password_bytes(form_data.password), _DUMMY_HASH)
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if not verify_password(form_data.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     # Crea el JWT
     token = create_access_token(
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
 from pathlib import Path
@@ -14,6 +14,18 @@ DB_FILE = os.getenv("DB_FILE", "auth.db")  # en productos será "productos.db",
 DB_PATH = BASE_DIR / DB_FILE
 DATABASE_URL = f"sqlite:///{DB_PATH.as_posix()}"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, pool_pre_ping=True)
+
+# WAL: los lectores no se bloquean con las escrituras y el commit no hace fsync completo (synchronous=NORMAL)
+@event.listens_for(engine, "connect")
+def _pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -1,9 +1,10 @@
 from .db import Base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, LargeBinary
 
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True, nullable=False)
-    password_hash = Column(String, nullable=False)
+    # hash bcrypt guardado como bytes, tal cual lo usan hashpw/checkpw
+    password_hash = Column(LargeBinary, nullable=False)
     role = Column(String, default="user", nullable=False)
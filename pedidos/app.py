@@ -1,16 +1,23 @@
-import os,time, requests
-from typing import List
-from pydantic import BaseModel
+import os, time, math, asyncio, httpx
+from typing import List, Optional
+from datetime import datetime
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from itertools import groupby
+from pydantic import BaseModel, ConfigDict, field_validator
 from fastapi import FastAPI, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError, ExpiredSignatureError
-from sqlalchemy.orm import Session
+import jwt
+from jwt import ExpiredSignatureError, InvalidTokenError as JWTError
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session, selectinload
 from .db import Base, engine, SessionLocal
 from .models import Order, OrderItem
 from pathlib import Path
 from dotenv import load_dotenv
 
-import os, time, requests, hashlib
+import os, time, hashlib
 from pathlib import Path
 from dotenv import load_dotenv, dotenv_values
 
@@ -31,10 +38,33 @@ if not SECRET_KEY:
 
 
 oauth2_scheme = HTTPBearer()
-app = FastAPI(title="Pedidos Service")
+
+# Cliente HTTP async compartido: pool de conexiones keep-alive hacia Productos, sin bloquear threads del server.
+# El transporte reintenta (hasta 2 veces) los fallos de conexión reutilizando el mismo pool.
+# Se crea y se cierra con el ciclo de vida de la app, así un reinicio en el mismo proceso arma uno nuevo
+HTTPX: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global HTTPX
+    HTTPX = httpx.AsyncClient(
+        base_url=PRODUCTOS_URL, timeout=5.0,
+        transport=httpx.AsyncHTTPTransport(
+            retries=2, limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)),
+    )
+    try:
+        yield
+    finally:
+        await HTTPX.aclose()
+
+app = FastAPI(title="Pedidos Service", lifespan=lifespan)
 
 # ---------- DB init ----------
 Base.metadata.create_all(bind=engine)
+# create_all no agrega índices nuevos a tablas que ya existían
+for _table in Base.metadata.sorted_tables:
+    for _index in _table.indexes:
+        _index.create(bind=engine, checkfirst=True)
 
 def get_db():
     db = SessionLocal()
@@ -49,22 +79,30 @@ class CurrentUser:
         self.id = user_id
         self.role = role
 
+# Verificar el token es trabajo puro de CPU (HMAC + JSON): se memoiza por token para no repetirlo en cada request
+@lru_cache(maxsize=4096)
+def _decode(token: str):
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    sub = payload.get("sub")
+    return (int(sub) if sub is not None else None), payload.get("role", "user"), payload.get("exp")
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme)) -> CurrentUser:
     if not credentials or credentials.scheme.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Invalid auth scheme")
     token = credentials.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        sub  = payload.get("sub")
-        role = payload.get("role", "user")
-        if sub is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return CurrentUser(user_id=int(sub), role=role)
+        sub, role, exp = _decode(token)
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except JWTError as e:
         print("JWT decode error (Pedidos):", e)
         raise HTTPException(status_code=401, detail="Invalid token")
+    # el resultado cacheado puede haber vencido desde que se verificó
+    if exp is not None and exp <= time.time():
+        raise HTTPException(status_code=401, detail="Token expired")
+    if sub is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return CurrentUser(user_id=sub, role=role)
 
 # ---------- Schemas ----------
 class OrderItemIn(BaseModel):
@@ -74,51 +112,106 @@ class OrderItemIn(BaseModel):
 class CreateOrderIn(BaseModel):
     items: List[OrderItemIn]
 
+# Salida: pydantic-core lee los atributos del ORM (o las claves de un dict) y arma el JSON sin pasar por dicts a mano
+class OrderItemOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    product_id: int
+    qty: int
+    unit_price: float
+
+class OrderOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    status: str
+    total_amount: float
+    items: List[OrderItemOut]
+    created_at: Optional[datetime]
+
+    @field_validator("total_amount")
+    @classmethod
+    def _round_total(cls, v: float) -> float:
+        return round(v, 2)
+
 # ---------- Helpers a Productos ----------
+# Rutas de Productos armadas una sola vez al cargar el módulo
+_URL_CHECK_BATCH   = "/stock/check-batch"
+_URL_RESERVE_BATCH = "/stock/reserve-batch"
+_URL_INC_TPL       = "/stock/{}/increase".format
+
+# Se arma una vez por request y se reutiliza en todas las llamadas a Productos
 def _auth_headers(token: str):
-    return {"Authorization": f"Bearer {token}"}
+    return {"Authorization": "Bearer " + token}
+
+def _batch_body(items):
+    return {"items": [{"product_id": pid, "qty": qty} for pid, qty in items]}
 
-def productos_check_stock(token: str, product_id: int, qty: int):
-    url = f"{PRODUCTOS_URL}/stock/check"
+def _detail_product_id(r):
+    try: return r.json()["detail"]["product_id"]
+    except: return None
+
+# Verifica todos los items en un solo request; devuelve una respuesta por item, alineada con `items`
+async def productos_check_stock_batch(headers: dict, items):
     try:
-        r = requests.get(url, params={"product_id": product_id, "qty": qty},
-                         headers=_auth_headers(token), timeout=5)
-    except requests.RequestException as e:
+        r = await HTTPX.post(_URL_CHECK_BATCH, json=_batch_body(items), headers=headers)
+    except httpx.RequestError as e:
         raise HTTPException(status_code=503, detail=f"Productos no responde (check): {e}")
     if r.status_code == 401:
         raise HTTPException(status_code=401, detail="Token inválido para Productos (check)")
     if r.status_code == 404:
-        raise HTTPException(status_code=404, detail=f"Producto {product_id} no existe (check)")
+        raise HTTPException(status_code=404, detail=f"Producto {_detail_product_id(r)} no existe (check)")
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=f"Error en Productos (check): {r.text}")
-    return r.json()
+    return r.json()["items"]
 
-def productos_decrease(token: str, product_id: int, amount: int):
-    url = f"{PRODUCTOS_URL}/stock/{product_id}/decrease"
+# Reserva todos los items de forma atómica en Productos (o ninguno)
+async def productos_reserve_batch(headers: dict, items):
     try:
-        r = requests.patch(url, params={"amount": amount},
-                           headers=_auth_headers(token), timeout=5)
-    except requests.RequestException as e:
+        r = await HTTPX.post(_URL_RESERVE_BATCH, json=_batch_body(items), headers=headers)
+    except httpx.RequestError as e:
         raise HTTPException(status_code=503, detail=f"Productos no responde (decrease): {e}")
-    return r  # el caller decide qué hacer con el status
+    if r.status_code == 409:
+        raise HTTPException(status_code=409, detail=f"Stock insuficiente (decrease) para product_id={_detail_product_id(r)}.")
+    if r.status_code == 401:
+        raise HTTPException(status_code=401, detail="Token inválido para Productos (decrease)")
+    if r.status_code == 404:
+        raise HTTPException(status_code=404, detail=f"Producto {_detail_product_id(r)} no encontrado al reservar")
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=f"Error en Productos (decrease): {r.text}")
+    return r.json()
 
-def productos_increase(token: str, product_id: int, amount: int):
-    url = f"{PRODUCTOS_URL}/stock/{product_id}/increase"
+async def productos_increase(headers: dict, product_id: int, amount: int):
     try:
-        return requests.patch(url, params={"amount": amount},
-                              headers=_auth_headers(token), timeout=5)
-    except requests.RequestException:
+        return await HTTPX.patch(_URL_INC_TPL(product_id), params={"amount": amount}, headers=headers)
+    except httpx.RequestError:
         return None  # best-effort
 
 # ---------- Utils ----------
-def order_to_dict(o: Order):
-    return {
-        "id": o.id,
-        "status": o.status,
-        "total_amount": round(o.total_amount, 2),
-        "items": [{"product_id": it.product_id, "qty": it.qty, "unit_price": it.unit_price} for it in o.items],
-        "created_at": o.created_at.isoformat() if o.created_at else None,
-    }
+# Total del pedido a partir de (product_id, qty, unit_price); fsum suma en C y sin acumular error de redondeo
+def order_total(enriched):
+    return math.fsum(price * qty for _, qty, price in enriched)
+
+# Lectura sin ORM: pedidos + items en un solo SELECT con outer join, filas planas (sin instancias ni identity map)
+_ORDERS, _ITEMS = Order.__table__, OrderItem.__table__
+_ORDER_ROWS = select(
+    _ORDERS.c.id, _ORDERS.c.user_id, _ORDERS.c.status, _ORDERS.c.total_amount, _ORDERS.c.created_at,
+    _ITEMS.c.product_id, _ITEMS.c.qty, _ITEMS.c.unit_price,
+).select_from(_ORDERS.outerjoin(_ITEMS))
+
+# las filas tienen que venir ordenadas por pedido; arma un dict por pedido con la forma de OrderOut
+def rows_to_orders(rows):
+    orders = []
+    for _, group in groupby(rows, key=lambda r: r.id):
+        group = list(group)
+        o = group[0]
+        orders.append({
+            "id": o.id,
+            "status": o.status,
+            "total_amount": o.total_amount,
+            "items": [{"product_id": r.product_id, "qty": r.qty, "unit_price": r.unit_price}
+                      for r in group if r.product_id is not None],
+            "created_at": o.created_at,
+        })
+    return orders
 
 # ---------- Endpoints utilitarios ----------
 @app.get("/health")
@@ -129,108 +222,118 @@ def whoami(user: CurrentUser = Depends(get_current_user)):
     return {"id": user.id, "role": user.role}
 
 # ---------- Endpoints de negocio ----------
-@app.post("/orders", status_code=201)
-def create_order(
+@app.post("/orders", status_code=201, response_model=OrderOut)
+async def create_order(
     payload: CreateOrderIn,
     db: Session = Depends(get_db),
     user: CurrentUser = Depends(get_current_user),
     credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme),
 ):
-    token = credentials.credentials
+    headers = _auth_headers(credentials.credentials)
     if not payload.items:
         raise HTTPException(status_code=400, detail="Pedido vacío")
 
-    # 1) Verificar stock y obtener precios
-    enriched = []
+    # 1) Verificar stock y obtener precios (un solo request a Productos para todo el pedido)
     for it in payload.items:
         if it.qty <= 0:
             raise HTTPException(status_code=400, detail="qty debe ser > 0")
-        chk = productos_check_stock(token, it.product_id, it.qty)
+    checks = await productos_check_stock_batch(headers, [(it.product_id, it.qty) for it in payload.items])
+
+    enriched = []
+    for it, chk in zip(payload.items, checks):
         if not chk.get("ok", False):
             available = chk.get("available", 0)
             raise HTTPException(status_code=409,
                                 detail=f"Sin stock para product_id={it.product_id}: piden {it.qty}, hay {available}.")
         enriched.append((it.product_id, it.qty, float(chk.get("price", 0.0))))
 
-    # 2) Crear orden + items
-    order = Order(user_id=user.id, status="CREATED", total_amount=0.0)
-    db.add(order); db.flush()
+    # 2) Guardar orden + items como PENDING antes de tocar el stock: si el proceso muere después de reservar,
+    #    queda el registro del pedido para conciliar con Productos (SQLite es sync: va al threadpool)
+    def _save_pending():
+        order = Order(user_id=user.id, status="PENDING", total_amount=order_total(enriched))
+        db.add(order); db.flush()
+
+        # un solo INSERT (executemany) para todos los items, sin instanciar OrderItem por fila
+        rows = [{"order_id": order.id, "product_id": pid, "qty": qty, "unit_price": price} for pid, qty, price in enriched]
+        db.bulk_insert_mappings(OrderItem, rows)
+        # todo lo que devuelve el endpoint ya está en memoria (created_at vino en el RETURNING del INSERT)
+        out = {
+            "id": order.id, "total_amount": order.total_amount, "created_at": order.created_at,
+            "items": [{"product_id": r["product_id"], "qty": r["qty"], "unit_price": r["unit_price"]} for r in rows],
+        }
+        db.commit()
+        return out
 
-    total = 0.0
-    for pid, qty, price in enriched:
-        total += price * qty
-        db.add(OrderItem(order_id=order.id, product_id=pid, qty=qty, unit_price=price))
-    order.total_amount = total
-    db.commit(); db.refresh(order)
+    out = await run_in_threadpool(_save_pending)
 
-    # 3) Reservar stock en Productos
+    # 3) Reservar stock en Productos (atómico del lado de Productos: si falla no quedó nada reservado)
+    items = [(pid, qty) for pid, qty, _ in enriched]
+    reserve_error = None
     try:
-        for pid, qty, _ in enriched:
-            r = productos_decrease(token, pid, qty)
-            if r.status_code == 409:
-                # revertir lo ya reservado
-                for pid2, qty2, _ in enriched:
-                    if pid2 == pid: break
-                    try: productos_increase(token, pid2, qty2)
-                    except: pass
-                detail = ""
-                try: detail = r.json().get("detail", "")
-                except: detail = r.text
-                raise HTTPException(status_code=409, detail=f"Stock insuficiente (decrease). {detail}")
-            if r.status_code == 401:
-                raise HTTPException(status_code=401, detail="Token inválido para Productos (decrease)")
-            if r.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Producto {pid} no encontrado al reservar")
-            if r.status_code >= 400:
-                raise HTTPException(status_code=r.status_code, detail=f"Error en Productos (decrease): {r.text}")
-    except HTTPException:
-        order.status = "CANCELLED"
+        await productos_reserve_batch(headers, items)
+    except HTTPException as e:
+        reserve_error = e
+
+    # 4) Pasar el pedido a CREATED, o a CANCELLED si la reserva falló (UPDATE directo, sin recargar la instancia)
+    status = "CANCELLED" if reserve_error else "CREATED"
+    def _set_status():
+        db.execute(update(Order).where(Order.id == out["id"]).values(status=status))
         db.commit()
-        raise
 
-    # 4) Confirmar
-    db.commit(); db.refresh(order)
-    return order_to_dict(order)
+    try:
+        await run_in_threadpool(_set_status)
+    except Exception:
+        # no se pudo confirmar el pedido: devolver a Productos lo que ya se reservó (queda PENDING para revisar)
+        if reserve_error is None:
+            await asyncio.gather(*[productos_increase(headers, pid, qty) for pid, qty in items],
+                                 return_exceptions=True)
+        raise
+    if reserve_error:
+        raise reserve_error
+    return OrderOut.model_validate({**out, "status": status})
 
-@app.get("/orders")
+@app.get("/orders", response_model=List[OrderOut])
 def list_orders(all: bool = False, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
-    q = db.query(Order)
+    q = _ORDER_ROWS
     if not (all and user.role == "admin"):
-        q = q.filter(Order.user_id == user.id)
-    return [order_to_dict(o) for o in q.order_by(Order.created_at.desc()).all()]
+        q = q.where(_ORDERS.c.user_id == user.id)
+    rows = db.execute(q.order_by(_ORDERS.c.created_at.desc(), _ORDERS.c.id.desc(), _ITEMS.c.id)).all()
+    return rows_to_orders(rows)
 
-@app.get("/orders/{order_id}")
+@app.get("/orders/{order_id}", response_model=OrderOut)
 def get_order(order_id: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
-    o = db.query(Order).filter(Order.id == order_id).first()
-    if not o: raise HTTPException(status_code=404, detail="Order not found")
-    if user.role != "admin" and o.user_id != user.id:
+    rows = db.execute(_ORDER_ROWS.where(_ORDERS.c.id == order_id).order_by(_ITEMS.c.id)).all()
+    if not rows: raise HTTPException(status_code=404, detail="Order not found")
+    if user.role != "admin" and rows[0].user_id != user.id:
         raise HTTPException(status_code=403, detail="Forbidden")
-    return order_to_dict(o)
+    return rows_to_orders(rows)[0]
 
-@app.post("/orders/{order_id}/cancel")
-def cancel_order(
+@app.post("/orders/{order_id}/cancel", response_model=OrderOut)
+async def cancel_order(
     order_id: int,
     db: Session = Depends(get_db),
     user: CurrentUser = Depends(get_current_user),
     credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme),
 ):
-    token = credentials.credentials
-    o = db.query(Order).filter(Order.id == order_id).first()
+    headers = _auth_headers(credentials.credentials)
+    o = await run_in_threadpool(lambda: db.query(Order).options(selectinload(Order.items)).filter(Order.id == order_id).first())
     if not o: raise HTTPException(status_code=404, detail="Order not found")
     if user.role != "admin" and o.user_id != user.id:
         raise HTTPException(status_code=403, detail="Forbidden")
     if o.status != "CREATED":
         raise HTTPException(status_code=409, detail=f"No se puede cancelar en estado {o.status}")
 
-    for it in o.items:
-        try: productos_increase(token, it.product_id, it.qty)
-        except: pass
+    await asyncio.gather(*[productos_increase(headers, it.product_id, it.qty) for it in o.items],
+                         return_exceptions=True)
 
-    o.status = "CANCELLED"
-    db.commit(); db.refresh(o)
-    return order_to_dict(o)
+    def _cancel():
+        o.status = "CANCELLED"
+        db.commit(); db.refresh(o)
+        return OrderOut.model_validate(o)
+
+    return await run_in_threadpool(_cancel)
 
-@app.post("/orders/{order_id}/confirm")
+@app.post("/orders/{order_id}/confirm", response_model=OrderOut)
 def confirm_order(order_id: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
     o = db.query(Order).filter(Order.id == order_id).first()
     if not o: raise HTTPException(status_code=404, detail="Order not found")
@@ -240,5 +343,5 @@ def confirm_order(order_id: int, db: Session = Depends(get_db), user: CurrentUse
         raise HTTPException(status_code=409, detail=f"No se puede confirmar en estado {o.status}")
     o.status = "CONFIRMED"
     db.commit(); db.refresh(o)
-    return order_to_dict(o)
+    return o
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, Float, String, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .db import Base
@@ -7,12 +7,16 @@ class Order(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True, nullable=False)
-    status = Column(String, default="CREATED")   # CREATED | CONFIRMED | CANCELLED
+    status = Column(String, default="CREATED")   # PENDING | CREATED | CONFIRMED | CANCELLED
     total_amount = Column(Float, default=0)
     # Asigna automáticamente la fecha/hora actual desde la BD cuando se inserta el registro
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     # Relación 1 a N con OrderItem, permite acceso bidireccional y elimina ítems huérfanos al borrar el pedido
     items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
+    # Cubre el filtro por usuario y el ORDER BY created_at de list_orders sin ordenar en memoria
+    __table_args__ = (Index("ix_orders_user_created", "user_id", "created_at"),)
+    # El INSERT trae created_at (server_default) con RETURNING, sin un SELECT aparte
+    __mapper_args__ = {"eager_defaults": True}
 
 class OrderItem(Base):
     __tablename__ = "order_items"
@@ -22,3 +26,5 @@ class OrderItem(Base):
     qty = Column(Integer, nullable=False)
     unit_price = Column(Float, nullable=False)
     order = relationship("Order", back_populates="items")
+    # Para traer los items de un pedido (join con orders) sin recorrer toda la tabla
+    __table_args__ = (Index("ix_items_order", "order_id"),)
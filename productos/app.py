@@ -1,44 +1,57 @@
 from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from jose import jwt, JWTError, ExpiredSignatureError
-from typing import Optional
+from contextlib import asynccontextmanager
+from sqlalchemy import select, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+import jwt
+from jwt import ExpiredSignatureError, InvalidTokenError as JWTError
+from typing import Optional, List
+from pydantic import BaseModel
 from .db import Base, engine, SessionLocal
 from .models import Product, Stock
-import os
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse
 
-import os, time, requests, hashlib
+import time, hashlib, threading
+from cachetools import TTLCache
 from pathlib import Path
-from dotenv import load_dotenv, dotenv_values
+from functools import lru_cache, cached_property
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # Cargar SIEMPRE el .env local (no el de la raíz)
 ENV_PATH = Path(__file__).resolve().parent / ".env"
 
+# Configuración del servicio: se lee una sola vez (.env + entorno) y queda cacheada
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=ENV_PATH, extra="ignore")
 
-load_dotenv(dotenv_path=ENV_PATH, override=True)   # variables al entorno
+    secret_key: str = ""
+    algorithm: str = "HS256"
+    productos_url: str = "http://127.0.0.1:8002"
 
-# Prioriza lo que diga pedidos/.env; si no hay, toma del entorno
-SECRET_KEY    = os.getenv("SECRET_KEY")
-ALGORITHM     = os.getenv("ALGORITHM", "HS256")
-PRODUCTOS_URL = os.getenv("PRODUCTOS_URL", "http://127.0.0.1:8002")
+    # Prioriza lo que diga productos/.env; si no hay, toma del entorno
+    @classmethod
+    def settings_customise_sources(cls, settings_cls, init_settings, env_settings, dotenv_settings, file_secret_settings):
+        return init_settings, dotenv_settings, env_settings, file_secret_settings
 
-if not SECRET_KEY:
-    raise RuntimeError("SECRET_KEY no está definida en pedidos/.env ni en el entorno")
+    # Lista de algoritmos armada una sola vez (Settings se cachea)
+    @cached_property
+    def jwt_algorithms(self) -> tuple:
+        return (self.algorithm,)
 
-oauth2_scheme = HTTPBearer()
-app = FastAPI(title="Productos Service")
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
 
+if not get_settings().secret_key:
+    raise RuntimeError("SECRET_KEY no está definida en productos/.env ni en el entorno")
 
-# ---------------- DB init ----------------
-Base.metadata.create_all(bind=engine)
+oauth2_scheme = HTTPBearer()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        # # entrega la sesion de la db al endpoint que lo necesite 
+# ---------------- DB init ----------------
+async def get_db():
+    # entrega la sesion de la db al endpoint que lo necesite (se cierra sola al salir del with)
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # ---------------- Auth helpers ----------------
 class CurrentUser:
@@ -46,6 +59,13 @@ class CurrentUser:
         self.id = user_id
         self.role = role
 
+# Tokens ya verificados: sha256(token) -> (CurrentUser, vence_en). Nunca se guardan tokens que fallaron la verificación
+_JWT_CACHE_TTL = 60
+_jwt_cache = TTLCache(maxsize=10000, ttl=_JWT_CACHE_TTL)
+_jwt_cache_lock = threading.Lock()
+# "require" hace que PyJWT rechace tokens sin sub, así no hace falta chequearlo a mano
+_JWT_OPTS = {"require": ["sub"]}
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme)) -> CurrentUser:
     # Aseguramos que sea "Bearer"
     if not credentials or credentials.scheme.lower() != "bearer":
@@ -53,17 +73,29 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_
 
     token = credentials.credentials  # <— el JWT puro (sin la palabra Bearer)
 
+    key = hashlib.sha256(token.encode()).hexdigest()
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(key)
+    # la entrada nunca vive más que el exp del token
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        sub = payload.get("sub")
-        role = payload.get("role", "user")
-        if sub is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return CurrentUser(user_id=int(sub), role=role)
+        settings = get_settings()
+        payload = jwt.decode(token, settings.secret_key, algorithms=settings.jwt_algorithms, options=_JWT_OPTS)
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    role = payload.get("role", "user")
+    user = CurrentUser(user_id=int(payload["sub"]), role=role)
+
+    expires_at = time.time() + _JWT_CACHE_TTL
+    if payload.get("exp") is not None:
+        expires_at = min(expires_at, payload["exp"])
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (user, expires_at)
+    return user
 
 def require_admin(user: CurrentUser = Depends(get_current_user)) -> CurrentUser:
     if user.role != "admin":
@@ -71,109 +103,183 @@ def require_admin(user: CurrentUser = Depends(get_current_user)) -> CurrentUser:
     return user
 
 # ---------------- Seeds (solo una vez) ----------------
-def seed_products(db: Session):
-    # Solo inserta si no hay productos
-    if db.query(Product).count() == 0:
+async def seed_products(db: AsyncSession):
+    # Solo inserta si no hay productos (EXISTS corta en la primera fila, no cuenta toda la tabla)
+    if not await db.scalar(select(select(Product.id).exists())):
         items = [
             {"name": "Hielo Bolsa", "size_kg": 3.0,  "price": 15000, "stock": 100},
             {"name": "Hielo Bolsa", "size_kg": 10.0, "price": 35000, "stock": 50},
             {"name": "Hielo Bolsa", "size_kg": 25.0, "price": 70000, "stock": 20},
         ]
-        for it in items:
-            p = Product(name=it["name"], size_kg=it["size_kg"], price=it["price"], is_active=True)
-            db.add(p); db.flush()  # obtiene p.id sin cerrar la transacción
-            s = Stock(product_id=p.id, units_available=it["stock"])
-            db.add(s)
-        db.commit()
+        # un INSERT por tabla para todas las filas; RETURNING devuelve los ids en el mismo orden que `items`
+        ids = (await db.scalars(
+            insert(Product).returning(Product.id, sort_by_parameter_order=True),
+            [{"name": it["name"], "size_kg": it["size_kg"], "price": it["price"], "is_active": True} for it in items],
+        )).all()
+        await db.execute(insert(Stock), [{"product_id": pid, "units_available": it["stock"]} for pid, it in zip(ids, items)])
+        await db.commit()
 
-# Ejecuta la semilla solo una vez al arranque del proceso
-with SessionLocal() as _db:
-    seed_products(_db)
+# Crea las tablas y ejecuta la semilla una vez por proceso al arrancar (no al importar el módulo)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # create_all no agrega índices nuevos a tablas que ya existían
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+    async with SessionLocal() as db:
+        await seed_products(db)
+    yield
+
+app = FastAPI(title="Productos Service", lifespan=lifespan)
 
 # ---------------- Schemas simples ----------------
-def product_to_dict(p: Product):
+class StockItemIn(BaseModel):
+    product_id: int
+    qty: int
+
+class StockBatchIn(BaseModel):
+    items: List[StockItemIn]
+
+def product_to_dict(p: Product, units_available: Optional[int] = None):
+    if units_available is None:
+        units_available = p.stock.units_available if p.stock else 0
     return {
         "id": p.id,
         "name": p.name,
         "size_kg": p.size_kg,
         "price": p.price,
         "is_active": p.is_active,
-        "units_available": p.stock.units_available if p.stock else 0,
+        "units_available": units_available,
     }
 
+# Lecturas sin ORM: solo las columnas que se devuelven, producto + stock en un mismo SELECT
+_PRODUCT_ROWS = (select(Product.id, Product.name, Product.size_kg, Product.price, Product.is_active, Stock.units_available)
+                 .outerjoin(Stock, Stock.product_id == Product.id))
+
+def row_to_dict(r):
+    d = dict(r._mapping)
+    d["units_available"] = d["units_available"] or 0
+    return d
+
 # ---------------- Endpoints (requieren token) ----------------
-@app.get("/products")
-def list_products(db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
-    products = db.query(Product).filter(Product.is_active == True).all()
-    return [product_to_dict(p) for p in products]
-
-@app.get("/products/{product_id}")
-def get_product(product_id: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
-    p = db.query(Product).filter(Product.id == product_id, Product.is_active == True).first()
-    if not p:
+# Las lecturas calientes devuelven dicts/listas sin response_model: ORJSONResponse las serializa directo con orjson
+
+# Catálogo ya serializado, por unos segundos: se lee mucho más de lo que cambia.
+# Cualquier endpoint que modifique productos o stock lo invalida
+_products_cache = TTLCache(maxsize=1, ttl=3)
+# Versión del catálogo: si cambia mientras se espera la query, ese resultado ya puede estar viejo y no se guarda
+_products_version = 0
+
+def invalidate_products_cache():
+    global _products_version
+    _products_version += 1
+    _products_cache.clear()
+
+@app.get("/products", response_class=ORJSONResponse)
+async def list_products(db: AsyncSession = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    cached = _products_cache.get("all")
+    if cached is not None:
+        return cached
+    version = _products_version
+    rows = (await db.execute(_PRODUCT_ROWS.where(Product.is_active == True))).all()
+    result = [row_to_dict(r) for r in rows]
+    if version == _products_version:
+        _products_cache["all"] = result
+    return result
+
+@app.get("/products/{product_id}", response_class=ORJSONResponse)
+async def get_product(product_id: int, db: AsyncSession = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    r = (await db.execute(_PRODUCT_ROWS.where(Product.id == product_id, Product.is_active == True))).first()
+    if not r:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product_to_dict(p)
+    return row_to_dict(r)
 
 # -------- Admin --------
 @app.post("/products", status_code=201)
-def create_product(
+async def create_product(
     name: str, size_kg: float, price: float, initial_stock: int = 0,
-    db: Session = Depends(get_db), admin: CurrentUser = Depends(require_admin)
+    db: AsyncSession = Depends(get_db), admin: CurrentUser = Depends(require_admin)
 ):
     p = Product(name=name, size_kg=size_kg, price=price, is_active=True)
-    db.add(p); db.flush()
+    db.add(p); await db.flush()
     db.add(Stock(product_id=p.id, units_available=initial_stock))
-    db.commit(); db.refresh(p)
-    return product_to_dict(p)
+    await db.commit()
+    invalidate_products_cache()
+    # Sin refresh: id y columnas ya están en memoria (expire_on_commit=False) y el stock es el recién creado
+    return product_to_dict(p, initial_stock)
 
 @app.put("/products/{product_id}")
-def update_product(
+async def update_product(
     product_id: int, name: Optional[str] = None, size_kg: Optional[float] = None,
     price: Optional[float] = None, is_active: Optional[bool] = None,
-    db: Session = Depends(get_db), admin: CurrentUser = Depends(require_admin)
+    db: AsyncSession = Depends(get_db), admin: CurrentUser = Depends(require_admin)
 ):
-    p = db.query(Product).filter(Product.id == product_id).first()
+    p = await db.get(Product, product_id)
     if not p:
         raise HTTPException(status_code=404, detail="Product not found")
     if name is not None: p.name = name
     if size_kg is not None: p.size_kg = size_kg
     if price is not None: p.price = price
     if is_active is not None: p.is_active = is_active
-    db.commit(); db.refresh(p)
+    await db.commit()
+    invalidate_products_cache()
     return product_to_dict(p)
 
+# UPDATE condicional en un solo statement: descuenta solo si alcanza (sin leer antes, sin carrera entre dos descuentos)
+# y devuelve el stock resultante con RETURNING; None si no se tocó ninguna fila
+async def _decrement_stock(db: AsyncSession, product_id: int, amount: int):
+    if amount <= 0:
+        return None
+    return await db.scalar(
+        update(Stock)
+        .where(Stock.product_id == product_id, Stock.units_available >= amount)
+        .values(units_available=Stock.units_available - amount)
+        .returning(Stock.units_available)
+        .execution_options(synchronize_session=False))
+
 @app.patch("/stock/{product_id}/increase")
-def increase_stock(product_id: int, amount: int, db: Session = Depends(get_db), admin: CurrentUser = Depends(require_admin)):
-    s = db.query(Stock).filter(Stock.product_id == product_id).first()
-    if not s:
+async def increase_stock(product_id: int, amount: int, db: AsyncSession = Depends(get_db), admin: CurrentUser = Depends(require_admin)):
+    units = await db.scalar(
+        update(Stock)
+        .where(Stock.product_id == product_id)
+        .values(units_available=Stock.units_available + max(0, amount))
+        .returning(Stock.units_available)
+        .execution_options(synchronize_session=False))
+    if units is None:
         raise HTTPException(status_code=404, detail="Stock not found")
-    s.units_available += max(0, amount)
-    db.commit()
-    return {"product_id": product_id, "units_available": s.units_available}
+    await db.commit()
+    invalidate_products_cache()
+    return {"product_id": product_id, "units_available": units}
 
 @app.patch("/stock/{product_id}/decrease")
-def decrease_stock(product_id: int, amount: int, db: Session = Depends(get_db), admin: CurrentUser = Depends(require_admin)):
-    s = db.query(Stock).filter(Stock.product_id == product_id).first()
-    if not s:
-        raise HTTPException(status_code=404, detail="Stock not found")
-    if amount <= 0 or s.units_available < amount:
+async def decrease_stock(product_id: int, amount: int, db: AsyncSession = Depends(get_db), admin: CurrentUser = Depends(require_admin)):
+    units = await _decrement_stock(db, product_id, amount)
+    if units is None:
+        # no se descontó: distinguir "no existe" de "no alcanza"
+        if await db.get(Stock, product_id) is None:
+            raise HTTPException(status_code=404, detail="Stock not found")
         raise HTTPException(status_code=409, detail="Insufficient stock")
-    s.units_available -= amount
-    db.commit()
-    return {"product_id": product_id, "units_available": s.units_available}
+    await db.commit()
+    invalidate_products_cache()
+    return {"product_id": product_id, "units_available": units}
 
 # -------- Para Pedidos (verificación de stock) --------
-@app.get("/stock/check")
-def check_stock(product_id: int, qty: int, db: Session = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+@app.get("/stock/check", response_class=ORJSONResponse)
+async def check_stock(product_id: int, qty: int, db: AsyncSession = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
     if qty <= 0:
         return {"ok": False, "message": "La cantidad debe ser > 0", "product_id": product_id, "requested": qty}
 
-    p = db.query(Product).filter(Product.id == product_id, Product.is_active == True).first()
-    if not p:
+    # precio, estado y stock en un solo statement
+    row = (await db.execute(
+        select(Product.price, Product.is_active, Stock.units_available)
+        .outerjoin(Stock, Stock.product_id == Product.id)
+        .where(Product.id == product_id))).first()
+    if row is None or not row.is_active:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    s = db.query(Stock).filter(Stock.product_id == product_id).first()
-    available = s.units_available if s else 0
+    available = row.units_available or 0
     ok = available >= qty
 
     resp = {
@@ -181,10 +287,48 @@ def check_stock(product_id: int, qty: int, db: Session = Depends(get_db), user:
         "product_id": product_id,
         "requested": qty,
         "available": available,
-        "price": p.price
+        "price": row.price
     }
     if not ok:
         resp["message"] = f"No hay {qty}, pero hay {available} disponibles."
     else:
         resp["message"] = f"Stock suficiente: {available} disponibles."
-    return resp
\ No newline at end of file
+    return resp
+
+# -------- Para Pedidos (por lote: un solo round-trip por pedido) --------
+@app.post("/stock/check-batch", response_class=ORJSONResponse)
+async def check_stock_batch(payload: StockBatchIn, db: AsyncSession = Depends(get_db), user: CurrentUser = Depends(get_current_user)):
+    ids = {it.product_id for it in payload.items}
+    rows = (await db.execute(
+        select(Product.id, Product.price, Stock.units_available)
+        .outerjoin(Stock, Stock.product_id == Product.id)
+        .where(Product.id.in_(ids), Product.is_active == True))).all()
+    found = {pid: (price, units or 0) for pid, price, units in rows}
+
+    # una respuesta por item, en el mismo orden del pedido
+    results = []
+    for it in payload.items:
+        if it.product_id not in found:
+            raise HTTPException(status_code=404, detail={"message": "Product not found", "product_id": it.product_id})
+        price, available = found[it.product_id]
+        results.append({
+            "ok": it.qty > 0 and available >= it.qty,
+            "product_id": it.product_id,
+            "requested": it.qty,
+            "available": available,
+            "price": price,
+        })
+    return {"items": results}
+
+@app.post("/stock/reserve-batch")
+async def reserve_stock_batch(payload: StockBatchIn, db: AsyncSession = Depends(get_db), admin: CurrentUser = Depends(require_admin)):
+    # todo o nada: si un item no alcanza se descarta toda la transacción, no hace falta revertir desde Pedidos
+    for it in payload.items:
+        if await _decrement_stock(db, it.product_id, it.qty) is None:
+            await db.rollback()
+            if await db.get(Stock, it.product_id) is None:
+                raise HTTPException(status_code=404, detail={"message": "Stock not found", "product_id": it.product_id})
+            raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "product_id": it.product_id})
+    await db.commit()
+    invalidate_products_cache()
+    return {"reserved": [it.product_id for it in payload.items]}
@@ -1,5 +1,7 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from pathlib import Path
 import os
 
@@ -8,7 +10,29 @@ DB_FILE = os.getenv("DB_FILE", "productos.db")
 DB_PATH = BASE_DIR / DB_FILE
 
 # as_posix: Convierte el Path a un string con formato POSIX (usando / como separador)
-DATABASE_URL = f"sqlite:///{DB_PATH.as_posix()}"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = f"sqlite+aiosqlite:///{DB_PATH.as_posix()}"
+# Engine async (aiosqlite): los endpoints esperan la DB sin ocupar threads del threadpool.
+# Pool de conexiones explícito: se reutilizan las conexiones abiertas en vez de abrir el archivo en cada request
+engine = create_async_engine(
+    DATABASE_URL,
+    connect_args={"timeout": 30},
+    poolclass=AsyncAdaptedQueuePool, pool_size=25, max_overflow=25,
+    pool_pre_ping=True, pool_recycle=3600,
+)
+
+# WAL: los /stock/check no se bloquean detrás de los commits de stock y el commit no hace fsync completo (synchronous=NORMAL)
+# (los eventos de conexión se registran en el engine sync que envuelve al async)
+@event.listens_for(engine.sync_engine, "connect")
+def _pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.close()
+
+# expire_on_commit=False: después del commit los objetos siguen usables sin otra consulta (en async no hay lazy load implícito)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from .db import Base
 
@@ -13,9 +13,14 @@ class Product(Base):
     is_active = Column(Boolean, default=True)
 
     # Esa línea crea una relación 1 a 1 entre Product y Stock, permitiendo navegar en ambos sentidos, relacion 1 a 1. uselist: asegura que product.stock devuelva un único objeto, no una lista
-    stock = relationship("Stock", back_populates="product", uselist=False)
-    # Esa línea asegura que no puedas tener dos productos con el mismo nombre y tamaño en kilos, manteniendo la integridad de los datos
-    __table_args__ = (UniqueConstraint("name", "size_kg", name="uq_name_size"),)
+    # lazy="joined": el stock (1 a 1, casi siempre necesario) viene en el mismo SELECT del producto con un LEFT JOIN
+    stock = relationship("Stock", back_populates="product", uselist=False, lazy="joined")
+    # Esa línea asegura que no puedas tener dos productos con el mismo nombre y tamaño en kilos, manteniendo la integridad de los datos.
+    # El índice (is_active, id) resuelve el filtro "solo activos" de los listados y búsquedas sin recorrer la tabla
+    __table_args__ = (
+        UniqueConstraint("name", "size_kg", name="uq_name_size"),
+        Index("ix_products_active_id", "is_active", "id"),
+    )
 
 class Stock(Base):
     __tablename__ = "stock"